@@ -10,7 +10,8 @@
 #   "matplotlib",
 #   "numpy",
 #   "pandas",
-#   "scipy"
+#   "pillow",
+#   "pyarrow"
 # ]
 # ///
 
@@ -35,32 +36,17 @@ Usage:
 from docopt import docopt
 
 import numpy as np
-import pandas as pd
-import scipy.stats as stats
 import matplotlib.pyplot as plt
-import multiprocessing as mp
 
-from matplotlib import animation
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.cm import ScalarMappable
 from matplotlib.colors import LogNorm
+from PIL import Image
 
-from heatmap import HeatmapContext
+from heatmap import HeatmapContext, binned_mean, uniform_histogram
 
-def process_bin(bin_indices, data, x_centers, y_centers, z_centers, x, y, z, score_threshold):
-    """Process a single bin, returning median score if below threshold."""
-    x_bin, y_bin, z_bin = bin_indices
-    x_range = (x_centers[x_bin] - (x_centers[1] - x_centers[0]) / 2, x_centers[x_bin] + (x_centers[1] - x_centers[0]) / 2)
-    y_range = (y_centers[y_bin] - (y_centers[1] - y_centers[0]) / 2, y_centers[y_bin] + (y_centers[1] - y_centers[0]) / 2)
-    z_range = (z_centers[z_bin] - (z_centers[1] - z_centers[0]) / 2, z_centers[z_bin] + (z_centers[1] - z_centers[0]) / 2)
-
-    bin_points = data[(x >= x_range[0]) & (x < x_range[1]) &
-                      (y >= y_range[0]) & (y < y_range[1]) &
-                      (z >= z_range[0]) & (z < z_range[1])]
-
-    if not bin_points.empty:
-      median_score = bin_points['score'].median()
-      if median_score <= score_threshold:
-        return median_score, (x_bin, y_bin, z_bin)
-    return None
+# Most bins to scatter. Every point is re-projected and drawn on each frame.
+MAX_POINTS = 5000
 
 class Histogram3D(HeatmapContext):
   def __init__(self, args):
@@ -70,21 +56,17 @@ class Histogram3D(HeatmapContext):
     else:
       self.density_threshold_percentile=90
     self.jitter_strength=0.5
-    self.args = args
-
-  def bin_data(self, num_bins=40):
-    "Bin the data into a 40^3 grid based on min and max values."
-    x_min, x_max = self.x.min(), self.x.max()
-    y_min, y_max = self.y.min(), self.y.max()
-    z_min, z_max = self.z.min(), self.z.max()
+    self.animate: bool = args['--animate']
 
-    x_bins = np.linspace(x_min, x_max, num_bins + 1)
-    y_bins = np.linspace(y_min, y_max, num_bins + 1)
-    z_bins = np.linspace(z_min, z_max, num_bins + 1)
+  def bin_data(self, num_bins=40, values=None):
+    """Bin the data into a 40^3 grid based on min and max values.
 
-    hist, edges = np.histogramdd(
-      sample=[self.x, self.y, self.z],
-      bins=[x_bins, y_bins, z_bins])
+    If VALUES is given, take its mean per bin instead of counting rows."""
+    samples = (self.x_np, self.y_np, self.z_np)
+    if values is None:
+      hist, edges = uniform_histogram(samples, num_bins)
+    else:
+      hist, edges = binned_mean(samples, num_bins, values)
 
     x_centers = 0.5 * (edges[0][:-1] + edges[0][1:])
     y_centers = 0.5 * (edges[1][:-1] + edges[1][1:])
@@ -93,30 +75,49 @@ class Histogram3D(HeatmapContext):
     return hist, x_centers, y_centers, z_centers
 
   def plot(self) -> tuple:
-    hist, x_centers, y_centers, z_centers = self.bin_data(num_bins=40)
-
     if self.score:
-      # Get bins where the score is above the threshold
-      score_threshold = np.percentile(self.data['score'], self.density_threshold_percentile)
-      with mp.Pool(mp.cpu_count()) as pool:
-        results = pool.starmap(process_bin, [(bin_indices, self.data, x_centers, y_centers, z_centers, self.x, self.y, self.z, score_threshold) for bin_indices in np.ndindex(hist.shape)])
+      # Mean score per bin from one weighted pass over the data, rather than
+      # masking every row once per bin.
+      bin_means, x_centers, y_centers, z_centers = self.bin_data(
+        num_bins=40, values=self.data['score'])
 
-      color_values = [res[0] for res in results if res]
-      non_empty_bins = [res[1] for res in results if res]
-      non_empty_bins = np.array(non_empty_bins).T
+      # Get bins where the score is below the threshold
+      score_threshold = np.percentile(self.data['score'], self.density_threshold_percentile)
+      non_empty_bins = np.where(bin_means <= score_threshold)
+      color_values = bin_means[non_empty_bins]
 
       cmap = 'inferno_r'
     else:
+      hist, x_centers, y_centers, z_centers = self.bin_data(num_bins=40)
+
       # Filter based on density percentiles (non-multiprocessed)
-      density_threshold = np.percentile(hist.flatten(), self.density_threshold_percentile)
+      density_threshold = np.percentile(hist, self.density_threshold_percentile)
       non_empty_bins = np.where(hist >= density_threshold)
       color_values = hist[non_empty_bins]
       norm = LogNorm()
       cmap = self.cmap
 
-    # Jitter positions of bins to avoid perfect alignment
-    for d in self.dims:
-      setattr(self, 'jitter_' + d, np.random.uniform(-self.jitter_strength, self.jitter_strength, size=len(non_empty_bins[0])))
+    rng = np.random.default_rng()
+
+    num_over_threshold = len(color_values)
+    if num_over_threshold > MAX_POINTS:
+      # Keep the densest bins, or the best (lowest) scoring ones. Many bins
+      # tie at the cutoff (most dense bins hold a row or two), so sample the
+      # tied ones uniformly rather than keeping whichever come first, which
+      # would be a block of neighbouring x-slabs.
+      rank = color_values if self.score else -color_values
+      cutoff = np.partition(rank, MAX_POINTS - 1)[MAX_POINTS - 1]
+      above = np.flatnonzero(rank < cutoff)
+      tied = np.flatnonzero(rank == cutoff)
+      keep = np.concatenate(
+        [above, rng.choice(tied, MAX_POINTS - len(above), replace=False)])
+      non_empty_bins = tuple(b[keep] for b in non_empty_bins)
+      color_values = color_values[keep]
+
+    # Jitter positions of bins to avoid perfect alignment, in one draw for
+    # all three axes
+    self.jitter_x, self.jitter_y, self.jitter_z = rng.uniform(
+      -self.jitter_strength, self.jitter_strength, size=(3, len(non_empty_bins[0])))
 
     # Scatter the non-empty bins with color_values based on selected color option
     plt.style.use('dark_background')
@@ -126,8 +127,8 @@ class Histogram3D(HeatmapContext):
     # Customize plot
     self.ax.set_proj_type('persp', focal_length=0.2)
     self.set_axes_labels()
-    for d in c.dims:
-      getattr(self.ax, d + 'axis').set_pane_color((1.0, 1.0, 1.0, 0.0))
+    for axis in (self.ax.xaxis, self.ax.yaxis, self.ax.zaxis):
+      axis.set_pane_color((1.0, 1.0, 1.0, 0.0))
     self.ax.set_facecolor('black')
     self.fig.set_facecolor('black')
     self.ax.grid(False)
@@ -137,19 +138,28 @@ class Histogram3D(HeatmapContext):
     # alpha_values = (alpha_values - alpha_values.min()) / (alpha_values.max() - alpha_values.min())
     # alpha_values = np.clip(alpha_values, 0.5, None)
 
-    scatter = self.ax.scatter(
+    # Map colors once up front. A color-mapped scatter re-runs its norm and
+    # colormap on every draw, i.e. on every --animate frame.
+    mappable = ScalarMappable(
+      norm=norm if 'norm' in locals() else None,
+      cmap=cmap if 'cmap' in locals() else None)
+    mappable.set_array(color_values)
+
+    self.ax.scatter(
       x_centers[non_empty_bins[0]] + self.jitter_x,
       y_centers[non_empty_bins[1]] + self.jitter_y,
       z_centers[non_empty_bins[2]] + self.jitter_z,
-      c=color_values,
-      cmap=cmap if 'cmap' in locals() else None,
-      norm=norm if 'norm' in locals() else None,
+      c=mappable.to_rgba(color_values),
       alpha=0.8,
+      # Stroking an outline around every marker roughly doubles draw time.
+      linewidths=0,
+      # Saved to a vector format, one image instead of thousands of paths.
+      rasterized=True,
       s=((color_values - np.mean(color_values)) / np.std(color_values)) + 2 * 6)
 
     self.label_known_layouts()
 
-    cbar = c.fig.colorbar(mappable=scatter) # type: ignore[arg-type,index]
+    cbar = c.fig.colorbar(mappable=mappable, ax=self.ax, alpha=0.8) # type: ignore[arg-type,index]
 
     # XXX: Covers up the cbar label :c
     # cbar.ax.set_position([0.91, 0.1, 0.03, 0.8])
@@ -162,18 +172,27 @@ class Histogram3D(HeatmapContext):
 
     if self.title:
       plt.title(self.title)
-    elif self.score:
-      plt.title(f'Top {self.density_threshold_percentile}th Percentile by Score')
     else:
-      plt.title(f'Top {self.density_threshold_percentile}th Percentile by Density')
-
-    if self.args['--animate']:
-      def animate(i):
-        self.ax.view_init(elev=10, azim=i)
-        return scatter,
-      ani = animation.FuncAnimation(self.fig, animate, frames=np.arange(0, 360, 2), interval=1000, blit=True)
-      writer = animation.PillowWriter(fps=15, bitrate=1800)
-      ani.save(self.out, writer=writer)
+      title = f'Top {self.density_threshold_percentile}th Percentile by {"Score" if self.score else "Density"}'
+      if num_over_threshold > MAX_POINTS:
+        title += f'\n({MAX_POINTS:,} of {num_over_threshold:,} bins shown)'
+      plt.title(title)
+
+    if self.animate:
+      # Redraw the one figure per frame and grab the canvas directly, rather
+      # than going through FuncAnimation and a savefig call per frame.
+      # Pin the frame size, whatever figure.dpi the user has configured.
+      self.fig.set_dpi(100)
+      # Render through Agg whatever the backend; only Agg canvases expose a
+      # pixel buffer.
+      canvas = FigureCanvasAgg(self.fig)
+      frames = []
+      for azim in range(0, 360, 2):
+        self.ax.view_init(elev=10, azim=azim)
+        canvas.draw()
+        # The figure is opaque; RGB frames quantize to GIF better than RGBA.
+        frames.append(Image.fromarray(np.asarray(canvas.buffer_rgba())).convert('RGB'))
+      frames[0].save(self.out, save_all=True, append_images=frames[1:], duration=1000 // 15, loop=0)
 
     else:
       plt.show()
@@ -9,7 +9,8 @@
 #   "docopt",
 #   "numpy",
 #   "matplotlib",
-#   "pandas==2.2.3"
+#   "pandas==2.2.3",
+#   "pyarrow"
 # ]
 # ///
 
@@ -28,27 +29,28 @@ Usage:
   -t, --title TITLE  Graph title. [default: (2x) 2x4 w/ Thumb(s)]
   -o, --out OUT      Output file. [default: img.svg]
   -H, --hex          Use hexbins instead of hist2d.
-  -S, --score        Color by mean score instead of density.
+  -S, --score        Color by minimum score instead of density.
   --hide-best        Don't label "best" layout.
 """
 
 # === Imports ===
 import json
-import sys
+import os
 
 from abc import ABC, abstractmethod
-from typing import Any, Final, Literal
+from typing import Any, Literal
 
 from docopt import docopt
 
 import matplotlib
 import matplotlib.pyplot as plt
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import numpy as np
 
 from matplotlib.ticker import PercentFormatter
 from matplotlib.colors import LogNorm
-from matplotlib.lines import Line2D
 
 # === Variables ===
 
@@ -64,94 +66,224 @@ def maybe_upper(s: str) -> str:
   "Uppercase string S if it doesn't have any numbers in it."
   return s.upper() if s.isalpha() else s
 
+def uniform_bins(samples, num_bins: int) -> tuple:
+  """Assign rows of SAMPLES to NUM_BINS equal-width bins per axis.
+
+  Bins span each sample's min and max, so a row's bin is found by scaling
+  rather than by `np.histogramdd`'s binary search over the edges. Like it,
+  rows with a NaN on any axis are left out. Returns each remaining row's
+  flat (C-order) bin index, a list of bin edges, and the mask of rows kept
+  (None if that's all of them)."""
+  kept = np.logical_and.reduce([~np.isnan(sample) for sample in samples])
+  if kept.all():
+    kept = None
+  else:
+    samples = [sample[kept] for sample in samples]
+
+  flat = np.zeros(len(samples[0]), dtype=np.intp)
+  edges = []
+  for sample in samples:
+    lo, hi = sample.min(), sample.max()
+    if lo == hi:
+      # A constant column has no span to scale by; widen it like numpy does.
+      lo, hi = lo - 0.5, hi + 0.5
+    # Scale and accumulate in place, so each axis costs one float temporary.
+    scaled = sample - lo
+    scaled *= num_bins / (hi - lo)
+    idx = scaled.astype(np.intp)
+    # The max lands on the last edge; keep it in the last bin.
+    np.minimum(idx, num_bins - 1, out=idx)
+    flat *= num_bins
+    flat += idx
+    edges.append(np.linspace(lo, hi, num_bins + 1))
+  return flat, edges, kept
+
+def uniform_histogram(samples, num_bins: int) -> tuple:
+  """Histogram SAMPLES into NUM_BINS equal-width bins per axis.
+
+  Returns the histogram and a list of bin edges, like `np.histogramdd`."""
+  flat, edges, _ = uniform_bins(samples, num_bins)
+  shape = (num_bins,) * len(edges)
+  hist = np.bincount(flat, minlength=np.prod(shape))
+  return hist.reshape(shape), edges
+
+def binned_mean(samples, num_bins: int, values) -> tuple:
+  """Mean of VALUES per bin of SAMPLES, as binned by `uniform_bins`.
+
+  Rows are binned once and reused for both the counts and the sums. Empty
+  bins are NaN. Returns the means and a list of bin edges."""
+  flat, edges, kept = uniform_bins(samples, num_bins)
+  if kept is not None:
+    values = np.asarray(values)[kept]
+  shape = (num_bins,) * len(edges)
+  counts = np.bincount(flat, minlength=np.prod(shape))
+  sums = np.bincount(flat, weights=values, minlength=np.prod(shape))
+  # Only divide where there are rows; empty bins stay NaN.
+  means = np.divide(sums, counts, out=np.full_like(sums, np.nan), where=counts > 0)
+  return means.reshape(shape), edges
+
+def binned_min(samples, num_bins: int, values) -> tuple:
+  """Minimum of VALUES per bin of SAMPLES, as binned by `uniform_bins`.
+
+  Empty bins are NaN. Returns the minimums and a list of bin edges."""
+  flat, edges, kept = uniform_bins(samples, num_bins)
+  if kept is not None:
+    values = np.asarray(values)[kept]
+  shape = (num_bins,) * len(edges)
+  # `fmin` ignores NaN, so each bin takes its first row's value as-is.
+  mins = np.full(np.prod(shape), np.nan, dtype=np.result_type(values, np.float32))
+  np.fmin.at(mins, flat, values)
+  return mins.reshape(shape), edges
+
 class HeatmapContext(ABC):
   def __init__(self, args, dim: int) -> None:
-    for k, v in args.items():
-      setattr(self, k.lstrip('-').lower().replace('-', '_'), v)
-
-    self.load_data()
+    self.file: str = args['FILE']
+    self.title: str | None = args['--title']
+    self.out: str = args['--out']
+    self.score: bool = args['--score']
+    self.hex: bool = args.get('--hex', False)
+    self.hide_best: bool = args['--hide-best']
 
     self.dim = dim
-    self.dims = ['x','y','z'][:dim]
+    # Column labels of the plotted axes, in x, y(, z) order.
+    self.labels: list[str] = [args['-x'], args['-y'], args.get('-z')][:dim]
+    self.xlabel, self.ylabel = self.labels[:2]
+
+    self.load_data()
 
-    for d in self.dims:
-      label = getattr(self, d)
-      data = self.data[label]
-      setattr(self, d + 'label', label)
-      setattr(self, d, data)
+    # Binning goes straight to numpy, skipping pandas' per-call overhead.
+    columns = [self.data[label].to_numpy(copy=False) for label in self.labels]
+    self.x_np, self.y_np = columns[:2]
+    if dim == 3:
+      self.zlabel, self.z_np = self.labels[2], columns[2]
 
     with open('bin/freya_cmap.json', 'r') as f:
       self.cmap = matplotlib.colors.ListedColormap(json.load(f))
 
   def load_data(self) -> None:
-    "Read file from args and add known layouts."
+    "Read file from args (or its Parquet cache) and add known layouts."
+
+    # Only the axes, score and layout columns are ever read, and layout only
+    # to find known layouts in the data, so a TSV needn't have one.
+    label_layouts = bool(known_layouts) or not self.hide_best
+    def projection(columns) -> list[str]:
+      layout = ['layout'] if label_layouts and 'layout' in columns else []
+      return list(dict.fromkeys(self.labels + ['score'] + layout))
+
+    # Known layouts are rows laid out like the whole TSV, so its COLUMNS are
+    # needed even though only KEEP is loaded.
+    cache = self.file + '.parquet'
+    # The cache records the size and mtime of the TSV it was parsed from and
+    # is only used while both still match; comparing mtimes alone would miss
+    # a TSV replaced by an older copy.
+    stat = os.stat(self.file)
+    source = json.dumps({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}).encode()
+    data = None
+    if os.path.exists(cache):
+      try:
+        schema = pq.read_schema(cache)
+        if (schema.metadata or {}).get(b'keywhisker.source') == source:
+          # Parquet is columnar, so the other columns are never even decoded.
+          columns = schema.names
+          keep = projection(columns)
+          data = pd.read_parquet(cache, columns=keep)
+      except (OSError, pa.ArrowException):
+        pass # Unreadable cache; parse the TSV and rewrite it.
+    if data is None:
+      # The pyarrow engine parses on all cores.
+      data = pd.read_csv(self.file, sep='\t', engine='pyarrow')
+      columns = data.columns
+      keep = projection(columns)
+      # Parsing dominates startup on big files, so keep a columnar copy to
+      # read next time. It's only a cache; carry on if it can't be written,
+      # and don't convert the frame at all where it couldn't be.
+      if os.access(os.path.dirname(cache) or '.', os.W_OK):
+        # Write beside it and rename into place, so an interrupted write
+        # never leaves a truncated cache behind.
+        tmp = f'{cache}.{os.getpid()}.tmp'
+        try:
+          table = pa.Table.from_pandas(data)
+          table = table.replace_schema_metadata(
+            {**(table.schema.metadata or {}), b'keywhisker.source': source})
+          pq.write_table(table, tmp, compression='zstd')
+          os.replace(tmp, cache)
+        except (OSError, pa.ArrowException):
+          pass
+        finally:
+          if os.path.exists(tmp):
+            os.remove(tmp)
+      data = data[keep]
+
+    # Plotting doesn't need double precision, and single precision halves
+    # what every binning pass streams through.
+    data = data.astype({c: np.float32 for c in keep if c != 'layout'}, copy=False)
 
-    data = pd.read_csv(self.file, sep='\t')
-
-    # Concat known layouts into data, setting any missing columns to NaN.
     if not self.hide_best:
-      known_layouts['\"\"best\"\"'] = data.loc[data['score'].idxmin()]
-    df = pd.DataFrame([x[:len(data.columns)] for x in known_layouts.values()], columns=data.columns)
-    df['score'] = data['score'].mean()
-    # for col in data.columns.difference(df.columns):
-    #   df[col] = np.nan
+      # Padded out to the full TSV row, like the other known layouts.
+      known_layouts['\"\"best\"\"'] = data.iloc[np.nanargmin(data['score'].to_numpy())].reindex(columns)
 
-    # TEMP: Disabled when known layouts are in the data
-    data = pd.concat([data, df], ignore_index=True)
+    # Name the known layouts' columns once so they can be looked up by label.
+    self.known = pd.DataFrame(
+      [x[:len(columns)] for x in known_layouts.values()],
+      columns=columns, index=list(known_layouts))[keep]
 
+    # Known layouts aren't concatenated into DATA, which would copy all of
+    # it; `label_known_layouts` places any missing from DATA from KNOWN.
     self.data = data
 
   def set_axes_labels(self) -> None:
     "Set and style axis labels from args."
-    for d in self.dims:
-      set_label = getattr(self.ax, 'set_' + d + 'label')
-      set_label(maybe_upper(getattr(self, d + 'label')))
+    label_setters = [self.ax.set_xlabel, self.ax.set_ylabel]
+    axes = [self.ax.xaxis, self.ax.yaxis]
+    if self.dim == 3:
+      label_setters.append(self.ax.set_zlabel)
+      axes.append(self.ax.zaxis)
 
-      set_major_formatter = getattr(self.ax, d + 'axis').set_major_formatter
-      set_major_formatter(PercentFormatter(decimals=1))
+    for label, set_label, axis in zip(self.labels, label_setters, axes):
+      set_label(maybe_upper(label))
+      axis.set_major_formatter(PercentFormatter(decimals=1))
 
   def label_known_layouts(self) -> None:
     "Label known layouts on Axes AX."
     tab20 = matplotlib.colormaps.get_cmap('tab20b')
-    for layout, metrics in known_layouts.items():
-      if not self.data[self.data['layout'] == metrics[-1]].empty:
-      # if True:
-        color = 'red' if layout[0].isdigit() else 'orange'
-        pos: list[float] = []
-
-        for d in self.dims:
-          # pos += [metrics[getattr(self, d + 'label')]]
-
-          # XXX: FutureWarning: Series.__getitem__ treating keys as positions is
-          # deprecated. In a future version, integer keys will always be treated
-          # as labels (consistent with DataFrame behavior). To access a value by
-          # position, use `ser.iloc[pos]`
-          # but i don't get how to fix that here rn...
-          pos += [ # forgive me
-            metrics[self.data.columns.tolist().index(getattr(self, d + 'label'))]
-            if self.data[self.data['layout'] == metrics[-1]].empty
-            else self.data[self.data['layout'] == metrics[-1]].iloc[0][self.data.columns.tolist().index(getattr(self, d + 'label'))]
-          ]
-
-        # # XXX: Weird, if I comment this out the labels appear above all
-        # # previously scattered points (in 3D)... I guess that's just how
-        # # it works?
-        # self.ax.scatter(
-        #   *pos, # type: ignore[arg-type,misc]
-        #   label=layout,
-        #   marker='o',
-        #   s=25, color=color,
-        #   edgecolor='#555')
-
-        color_idx = (ord(layout[0]) - 65)
-        color_idx = color_idx * 4
-        if layout[1].isdigit():
-          color_idx = color_idx + (int(layout[1]) % 4)
-
-        self.ax.text( # type: ignore[call-arg]
-          *(pos[0], *pos[1:]), layout, # type: ignore[arg-type]
-          va='center', color='black', fontsize=6,
-          bbox=dict(facecolor='#D9D9D9', edgecolor=tab20(color_idx % 20), boxstyle='round', linewidth=2))
+    labels = self.labels
+
+    # Find every known layout in the data with one pass over the layout
+    # column, keeping the first row of each. Without layout names, every
+    # known layout is placed from KNOWN.
+    names = pd.Series(None, index=self.known.index, dtype=object)
+    matches = pd.DataFrame(columns=labels)
+    if 'layout' in self.known:
+      names = self.known['layout']
+      matches = self.data[self.data['layout'].isin(names)]
+      matches = matches.drop_duplicates('layout').set_index('layout')[labels]
+
+    for layout, name in names.items():
+      color = 'red' if layout[0].isdigit() else 'orange'
+
+      pos: list[float] = (
+        self.known.loc[layout, labels] if name not in matches.index
+        else matches.loc[name]).tolist()
+
+      # # XXX: Weird, if I comment this out the labels appear above all
+      # # previously scattered points (in 3D)... I guess that's just how
+      # # it works?
+      # self.ax.scatter(
+      #   *pos, # type: ignore[arg-type,misc]
+      #   label=layout,
+      #   marker='o',
+      #   s=25, color=color,
+      #   edgecolor='#555')
+
+      color_idx = (ord(layout[0]) - 65)
+      color_idx = color_idx * 4
+      if layout[1].isdigit():
+        color_idx = color_idx + (int(layout[1]) % 4)
+
+      self.ax.text( # type: ignore[call-arg]
+        *(pos[0], *pos[1:]), layout, # type: ignore[arg-type]
+        va='center', color='black', fontsize=6,
+        bbox=dict(facecolor='#D9D9D9', edgecolor=tab20(color_idx % 20), boxstyle='round', linewidth=2))
 
   @abstractmethod
   def plot(self) -> tuple:
@@ -179,7 +311,7 @@ class Histogram2D(HeatmapContext):
         mincnt = 1
 
       hist = self.ax.hexbin(
-        self.x, self.y,
+        self.x_np, self.y_np,
         # gridsize=(25,15), linewidths=0,
         gridsize=(40,24), linewidths=0,
         # gridsize=(45,24), linewidths=0,
@@ -190,6 +322,10 @@ class Histogram2D(HeatmapContext):
         mincnt=mincnt if 'mincnt' in locals() else None,
         reduce_C_function=reduce_C_function if 'reduce_C_function' in locals() else None) # type: ignore[arg-type]
 
+      # One embedded image instead of a polygon per hexagon in vector output;
+      # labels and text stay vector.
+      hist.set_rasterized(True)
+
       # This is also one of those things that's probably just for me
       if self.xlabel == 'sfb' and self.ylabel == "no_magic_sfb":
         self.ax.axline((5.2,5.2*0.923), slope=1, color='white')
@@ -219,41 +355,39 @@ class Histogram2D(HeatmapContext):
     else:
       if self.score:
         # Couldn't color by score by setting hist2d's `weights`, so I'll do the
-        # math myself and call `pcolormesh`.
-
-        # Create bins
-        x_bins, y_bins = (64, 64)
-        x_edges = np.linspace(self.x.min(), self.x.max(), x_bins + 1)
-        y_edges = np.linspace(self.y.min(), self.y.max(), y_bins + 1)
-        hist , xedges, yedges = np.histogram2d(self.x, self.y, bins=[x_edges, y_edges]) # type: ignore[list-item]
-
-        # Calculate means
-        bin_means = np.zeros_like(hist)
-        for i in range(x_bins):
-          for j in range(y_bins):
-            # Get indexes of points in bin
-            mask = ((self.x >= xedges[i]) & (self.x < xedges[i + 1]) &
-                    (self.y >= yedges[j]) & (self.y < yedges[j + 1]))
-            bin_means[i, j] = self.data.loc[mask, 'score'].min() if mask.any() else np.nan
-
-        hist = plt.pcolormesh(x_edges, y_edges, bin_means.T, cmap=cmap)
+        # math myself and call `imshow`.
+
+        # Take each bin's lowest score in one pass over the rows, rather than
+        # masking every row once per bin. Like the hexbins, cells show their
+        # best (minimum) score.
+        bin_mins, edges = binned_min(
+          (self.x_np, self.y_np), 64, self.data['score'].to_numpy())
+
+        hist = self.show_grid(bin_mins, edges, cmap=cmap)
         return (hist, hist)
       else:
-        hist = self.ax.hist2d(self.x, self.y, bins=64, norm=LogNorm())
-        return (hist, hist[3])
+        hist, edges = uniform_histogram((self.x_np, self.y_np), 64)
+        mesh = self.show_grid(hist, edges, norm=LogNorm())
+        return (hist, mesh)
+
+  def show_grid(self, grid, edges, **kwargs) -> Any:
+    """Draw GRID, binned on uniform EDGES, as an image on the Axes.
+
+    Uniform bins are just pixels, so `imshow` draws one image where
+    `pcolormesh` would build a quad per cell."""
+    x_edges, y_edges = edges
+    return self.ax.imshow(
+      grid.T, origin='lower', aspect='auto', interpolation='nearest',
+      extent=(x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]), **kwargs)
 
 # === Main ===
 if __name__ == "__main__":
   args = docopt(__doc__)
   c = Histogram2D(args)
 
-  c.fig: plt.Figure
-  c.ax: plt.Axes
-  fig, ax = plt.subplots(tight_layout=True)
-  setattr(c, 'fig', fig)
-  setattr(c, 'ax', ax)
+  c.fig, c.ax = plt.subplots(tight_layout=True)
   c.fig.patch.set_facecolor('#D9D9D9')
-  ax.set_facecolor("black")
+  c.ax.set_facecolor("black")
 
   hist, mappable = c.plot()
 
@@ -265,7 +399,7 @@ if __name__ == "__main__":
 
   if c.score:
     cbar.ax.invert_yaxis()
-    cbar.set_label("Mean score / cell\n(brighter is better)")
+    cbar.set_label("Min score / cell\n(brighter is better)")
   else:
     cbar.set_label("Generated layout density\n(per ~1/64²)")
 
@@ -1,8 +1,6 @@
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
-import numpy as np
-import sys
 
 # files = [('data/greedy_naive_runs.csv', '100k Naive greedy runs (5k iterations each)', (0, 0)),
 #          ('data/greedy_neighbor_runs.csv', '100k Deterministic greedy runs', (0, 1)),
@@ -21,16 +19,17 @@ fig.suptitle('Resulting Roll values over massed generation runs with various alg
 for (file, title, index) in files:
     ax = axs[index]
     data = pd.read_csv(file)[:10000]
-    minimum = data.amount.min()
-    mincount = data.amount.value_counts()[minimum]
-    maximum = data.amount.max()
-    maxcount = data.amount.value_counts()[maximum]
+    stats = data.amount.agg(['min', 'max', 'mean', 'median', 'std'])
+    minimum = stats['min']
+    mincount = (data.amount == minimum).sum()
+    maximum = stats['max']
+    maxcount = (data.amount == maximum).sum()
     total = len(data)
     print(f'  min {minimum} occurred {mincount} times ({100*mincount/total}%)')
     print(f'  max {maximum} occurred {maxcount} times ({100*maxcount/total}%)')
-    print(f'  mean {data.amount.mean()}')
-    print(f'  median {data.amount.median()}')
-    print(f'  std {data.amount.std()}')
+    print(f'  mean {stats["mean"]}')
+    print(f'  median {stats["median"]}')
+    print(f'  std {stats["std"]}')
     filtered = data[(data.amount > 20)]
     ax.hist2d(filtered.iteration, filtered.amount, bins=data.iteration.max() - data.iteration.min())
     # ax.set_xscale('log')